@@ -25,16 +25,40 @@ def get_parser():
 def run_main(args):
     check_lanes(args.uutnames)
 
+_conn_cache = {'t': 0, 'v': None}
+CONN_CACHE_TTL = 0.5
+
+def get_connections(force=False):
+    """afhba404.get_connections with a short TTL cache to skip repeated sysfs walks"""
+    if force or _conn_cache['v'] is None or time.monotonic() - _conn_cache['t'] > CONN_CACHE_TTL:
+        _conn_cache['v'] = afhba404.get_connections()
+        _conn_cache['t'] = time.monotonic()
+    return _conn_cache['v']
+
+_link_states = {}
+
+def get_link_states(lports, force=False):
+    """fetch link state for many lports in one pass, memoized per lport"""
+    if force:
+        for lport in lports:
+            _link_states.pop(lport, None)
+    for lport in lports:
+        if lport not in _link_states:
+            _link_states[lport] = afhba404.get_link_state(lport)
+    return {lport: _link_states[lport] for lport in lports}
+
 def check_lanes(uuts):
-    for conn in afhba404.get_connections().values():
-        if conn.uut in uuts or len(uuts) == 0:
-            check_lane_status(conn.uut, conn.dev, conn.cx)
+    conns = [conn for conn in get_connections().values()
+             if conn.uut in uuts or len(uuts) == 0]
+    get_link_states([conn.dev for conn in conns])
+    for conn in conns:
+        check_lane_status(conn.uut, conn.dev, conn.cx)
 
 def check_lane_status(uutname, lport, rport, uut=None, verbose=True):
     def output(msg):
         if verbose:
             print(msg)
-    link_state = afhba404.get_link_state(lport)
+    link_state = get_link_states([lport])[lport]
     if link_state.LANE_UP and link_state.RPCIE_INIT:
         output(f"[{uutname}:{rport} -> afhba.{lport}] Link Good")
         return True
@@ -51,7 +75,7 @@ def check_lane_status(uutname, lport, rport, uut=None, verbose=True):
         time.sleep(0.5)
         comm_api.TX_DISABLE = 0
         time.sleep(0.5)
-        link_state = afhba404.get_link_state(lport)
+        link_state = get_link_states([lport], force=True)[lport]
         if link_state.RPCIE_INIT:
             output(f'[{uutname}:{rport} -> afhba.{lport}] Link Fixed')
             return True
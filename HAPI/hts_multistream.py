@@ -68,14 +68,23 @@ from acq400_hapi.acq400_print import DISPLAY
 from acq400_hapi import afhba404
 import afhba_check_links
 import argparse
+import asyncio
 import time
 import os
 import re
 import subprocess
 import psutil
-from threading import Thread
+import numpy as np
+from pathlib import Path
+from threading import Thread, Condition
+from concurrent.futures import ThreadPoolExecutor
 import traceback
 
+_HN_RE = re.compile(r'^.+_(\d{3})$')
+
+# one devnull fd shared by every stream child, not one pair per Popen
+_DEVNULL = open(os.devnull, 'wb')
+
 def get_parser():
     parser = argparse.ArgumentParser(description='High Throughput Stream from up to 16 UUTS')
     acq400_hapi.Acq400UI.add_args(parser, transient=False)
@@ -113,6 +122,7 @@ class UutWrapper:
         self.state = None
         self.thread = None
         self.ended = False
+        self.poll_delay = 1
         self.streams = {}
         self.__attach_api()
         self.__set_id()
@@ -128,11 +138,6 @@ class UutWrapper:
     def get_state(self):
         self.state =  acq400_hapi.pv(self.api.s0.CONTINUOUS_STATE)
 
-    def get_state_forever(self):
-        while True:
-            self.get_state()
-            time.sleep(1)
-
     def start(self):
         self.get_state()
         if self.state != 'IDLE':
@@ -140,19 +145,10 @@ class UutWrapper:
             time.sleep(2)
         self.api.s0.streamtonowhered = "start"
 
-    def stop(self):
+    def request_stop(self):
         self.api.s0.streamtonowhered = "stop"
-        wc = 0
-        while self.state != 'IDLE':
-            time.sleep(1)
-            wc += 1
-            if wc > 10:
-                print(f'{self.name} unable to stop, dropping out')
-                return
-        if self.args.verbose > 0:
-            print(f'{self.name} has stopped')
-        return
-    
+
+
     def initialize(self):
         for lport, stream in self.streams.items():
             
@@ -162,10 +158,9 @@ class UutWrapper:
                 os._exit(1)
 
             data_columns = int(sum(stream.sites.values()) / 2)
-            spad_len = int(self.spad.split(',')[1])
 
             if self.args.hex_str:
-                hex_cmd = f"""Hex Cmd: hexdump -e '{data_columns + spad_len}/4 "%08x," "\\n"' /mnt/afhba.{lport}/{stream.rhost}/000000/{lport}.00"""
+                hex_cmd = f"""Hex Cmd: hexdump -e '{data_columns + self.spad_len}/4 "%08x," "\\n"' /mnt/afhba.{lport}/{stream.rhost}/000000/{lport}.00"""
                 PR.Cyan(hex_cmd)
 
             if self.args.check_spad > 0:
@@ -173,7 +168,7 @@ class UutWrapper:
                    die(f'Error: Cannot check spad if no spad: {self.spad}')
 
                 step = 1 if self.args.decimate is None else self.args.decimate
-                cmd = stream.get_checker_cmd(self.args, spad_len, data_columns, step)
+                cmd = stream.get_checker_cmd(self.args, self.spad_len, data_columns, step)
             else:
                 cmd = stream.get_cmd(self.args)
             if self.args.verbose > 0:
@@ -186,7 +181,9 @@ class UutWrapper:
         else:
             self.spad = self.api.s0.spad
 
-        self.spad_enabled = True if int(self.spad.split(',')[0]) else False
+        spad_fields = self.spad.split(',')
+        self.spad_enabled = bool(int(spad_fields[0]))
+        self.spad_len = int(spad_fields[1])
         if self.spad_enabled:
             for sp in ('1', '2', '3', '4' , '5', '6', '7'):
                 self.api.s0.sr("spad{}={}".format(sp, sp*8))
@@ -228,11 +225,11 @@ class UutWrapper:
 
     def __set_id(self):
         hostname = self.api.s0.HN
-        match = re.search(r'^.+_([0-9]{3})$', hostname)
+        match = _HN_RE.search(hostname)
         if not match:
             die(f'Error: {self.name} Hostname {hostname} is invalid')
         self.name = match.group()
-        self.id = match.group(1).lstrip('0')
+        self.id = str(int(match.group(1)))
 
     def __data_builder(self, map, streams):
         if self.name not in streams:
@@ -262,8 +259,11 @@ class UutWrapper:
                 out[port] = site_list
                 continue
             if map[self.id][port][0] == 'SPLIT':
-                out['A'] = dict(list(site_list.items())[len(site_list)//2:])
-                out['B'] = dict(list(site_list.items())[:len(site_list)//2])
+                items = list(site_list.items())
+                mid = len(items) // 2
+                out['A'] = dict(items[mid:])
+                out['B'] = dict(items[:mid])
+                assert out['A'].keys() | out['B'].keys() == site_list.keys(), 'SPLIT halves must partition the sitelist'
                 break
             for key in map[self.id][port]:
                 if key in site_list:
@@ -273,11 +273,74 @@ class UutWrapper:
         return out
 
     def __get_aggregator_sitelist(self):
-        sites = {}
-        for site in self.api.get_aggregator_sites():
+        sites = [str(site) for site in self.api.get_aggregator_sites()]
+        if not sites:
+            return {}
+        try:
+            reply = self.api.s0.sr(';'.join(f's{site}.active_chan' for site in sites))
+            values = [token.split('=')[-1] for token in reply.replace(';', ' ').split()]
+            if len(values) != len(sites):
+                raise ValueError(f'bad multi-knob reply: {reply}')
+            return {site: int(value) for site, value in zip(sites, values)}
+        except Exception:
+            return self.__get_aggregator_sitelist_threaded(sites)
+
+    def __get_aggregator_sitelist_threaded(self, sites):
+        def read_chan(site):
             site_conn = getattr(self.api, f's{site}')
-            sites[str(site)] = int(site_conn.active_chan)
-        return sites
+            return site, int(site_conn.active_chan)
+        with ThreadPoolExecutor(max_workers=len(sites)) as ex:
+            return dict(ex.map(read_chan, sites))
+
+class RampChecker:
+    """ in-process spad ramp check, replaces the isramp pipe stage
+
+        follows completed buffer filenames on the writer's stdout, memmaps
+        each file and verifies the ramp column increments by step """
+    def __init__(self, filenames, logfile, total_columns, ramp_column, step):
+        self.filenames = filenames
+        self.logfile = logfile
+        self.total_columns = total_columns
+        self.ramp_column = ramp_column
+        self.step = np.uint32(step)
+        self.samples = 0
+        self.errors = 0
+        self.first_error = None
+        self.last = None
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def check_file(self, fname):
+        buf = np.memmap(fname, dtype=np.uint32, mode='r')
+        usable = len(buf) - len(buf) % self.total_columns
+        ramp = buf[:usable].reshape(-1, self.total_columns)[:, self.ramp_column]
+        if len(ramp) == 0:
+            return
+        if self.last is not None and ramp[0] - self.last != self.step:
+            self.errors += 1
+            if self.first_error is None:
+                self.first_error = f'{fname} row 0'
+        jumps = np.flatnonzero(np.diff(ramp) != self.step)
+        if len(jumps) and self.first_error is None:
+            self.first_error = f'{fname} row {int(jumps[0]) + 1}'
+        self.errors += len(jumps)
+        self.samples += len(ramp)
+        self.last = ramp[-1]
+
+    def run(self):
+        for line in self.filenames:
+            fname = line.decode().strip()
+            if not fname:
+                continue
+            try:
+                self.check_file(fname)
+            except (OSError, ValueError):
+                continue
+            with open(self.logfile, 'w') as log:
+                log.write(f'Total: {self.samples // int(self.step)} Errors {self.errors} \n')
+                if self.first_error is not None:
+                    log.write(f'First error: {self.first_error}\n')
 
 class Stream:
     def __init__(self, lport, rport, rhost, sites):
@@ -285,36 +348,67 @@ class Stream:
         self.rport = rport
         self.rhost = rhost
         self.sites = sites
+        self.checker_args = None
         self.sites_str = ','.join(self.sites.keys())
         self.outroot = f"/mnt/afhba.{self.lport}/{self.rhost}"
         self.logfile = f"{self.outroot}/checker.log"
         Stream.kill_if_active(lport)
 
+    def make_outroot(self):
+        # stream-start time: must run after the configure_host stale data wipe
+        subprocess.run(['sudo', 'mkdir', '-p', '-m', '0777', self.outroot], check=False)
+
     def get_cmd(self, args):
-        os.system(f"sudo mkdir -p {self.outroot} -m 0777")
-        cmd = f"sudo RTM_DEVNUM={self.lport} NBUFS={args.nbuffers} CONCAT={args.concat} RECYCLE={args.recycle} OUTROOT={self.outroot} ./STREAM/rtm-t-stream-disk"
+        self.make_outroot()
+        cmd = f"sudo RTM_DEVNUM={self.lport} NBUFS={args.nbuffers} CONCAT={args.concat} RECYCLE={args.recycle} OUTROOT={self.outroot} IOU_SQPOLL=1 IOU_REGBUF=1 ./STREAM/rtm-t-stream-disk"
         return cmd
-        
+
     def get_checker_cmd(self, args, spad_len, data_columns, step):
         total_columns = data_columns + spad_len
         cmd = self.get_cmd(args)
-        cmd += f' | ./FUNCTIONAL_TESTS/isramp -N1 -m {total_columns} -c {data_columns} -s {step} -i 1 -L {self.logfile}'
-        os.system(f"umask 000 ; touch {self.logfile}")
+        self.checker_args = (total_columns, data_columns, int(step))
+        umask = os.umask(0)
+        try:
+            Path(self.logfile).touch(mode=0o666, exist_ok=True)
+        finally:
+            os.umask(umask)
         return cmd
         
     def run(self, cmd):
-        self.process = subprocess.Popen(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        time_start = time.time()
-        pid = afhba404.get_stream_pid(self.lport)
-        while True:
-            if pid != 0:
-                PR.Green(f'Started afhba.{self.lport} with PID {pid}')
-                self.pid = pid
-                break
-            if time.time() - time_start > 5:
-                die(f'Error: afhba.{self.lport} failed to start')
-            pid = afhba404.get_stream_pid(self.lport)
-            time.sleep(0.5)
+        if self.checker_args is not None:
+            self.process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=_DEVNULL,
+                                            close_fds=True)
+            self.checker = RampChecker(self.process.stdout, self.logfile, *self.checker_args)
+        else:
+            self.process = subprocess.Popen(cmd, shell=True, stdout=_DEVNULL, stderr=_DEVNULL,
+                                            close_fds=True)
+        pid = self.wait_stream_pid()
+        if pid == 0:
+            die(f'Error: afhba.{self.lport} failed to start')
+        PR.Green(f'Started afhba.{self.lport} with PID {pid}')
+        self.pid = pid
+
+    def wait_stream_pid(self, timeout=5, interval=0.05):
+        """wait for the streamer_pid knob to go nonzero: one pread per poll"""
+        deadline = time.monotonic() + timeout
+        try:
+            knob = Knob(f'/dev/rtm-t.{self.lport}.ctrl/streamer_pid')
+        except OSError:
+            knob = None
+        try:
+            while time.monotonic() < deadline:
+                if knob is not None:
+                    raw = knob.read()
+                    pid = int(raw) if raw else 0
+                else:
+                    pid = afhba404.get_stream_pid(self.lport)
+                if pid != 0:
+                    return pid
+                time.sleep(interval)
+        finally:
+            if knob is not None:
+                knob.close()
+        return 0
 
     def read_state(self):
         return afhba404.get_stream_state(self.lport)
@@ -326,9 +420,9 @@ class Stream:
 
     @staticmethod
     def get_config():
-        #returns dict with host AFHBA connections
+        #returns dict with host AFHBA connections, shares the cached scan with afhba_check_links
         config = {}
-        for conn in afhba404.get_connections().values():
+        for conn in afhba_check_links.get_connections().values():
             if conn.uut not in config:
                 config[conn.uut] = {}
             config[conn.uut][conn.dev] = {}
@@ -342,8 +436,7 @@ class Stream:
             return
 
         PR.Yellow(f'Warning: Killing afhba.{lport} with pid: {pid}')
-        cmd = 'sudo kill -9 {}'.format(pid)
-        result = os.system(cmd)
+        subprocess.run(['sudo', 'kill', '-9', str(pid)], check=False)
         retry = 0
         while retry < 4:
             time.sleep(1)
@@ -354,21 +447,31 @@ class Stream:
         die(f'Fatal Error: Stream failed to die {lport}')
 
 def stop_uuts(uut_collection):
-    threads = []
-    for uut_item in uut_collection:
-        if not uut_item.ended:
-            t = Thread(target=uut_item.stop)
-            t.start()
-            threads.append(t)
-            uut_item.ended = True
+    to_stop = [uut_item for uut_item in uut_collection if not uut_item.ended]
+    if not to_stop:
+        return
+    for uut_item in to_stop:
+        uut_item.ended = True
+
+    async def stop_all():
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(None, uut_item.request_stop) for uut_item in to_stop))
+        pending = await loop.run_in_executor(None, wait_all_idle, to_stop)
+        for uut_item in pending:
+            print(f'{uut_item.name} unable to stop, dropping out')
+        for uut_item in to_stop:
+            if uut_item not in pending and uut_item.args.verbose > 0:
+                print(f'{uut_item.name} has stopped')
+
+    stopper = Thread(target=lambda: asyncio.run(stop_all()))
+    stopper.start()
+    return stopper
 
 def object_builder(args):
     stream_config = Stream.get_config()
     map = get_parsed_map(args.map)
-    uut_collection = []
-    for uut_name in args.uutnames:
-        new_uut = UutWrapper(uut_name, args, map, stream_config)
-        uut_collection.append(new_uut)
+    with ThreadPoolExecutor(max_workers=len(args.uutnames)) as ex:
+        uut_collection = list(ex.map(lambda name: UutWrapper(name, args, map, stream_config), args.uutnames))
     return uut_collection
 
 def get_parsed_map(maps):
@@ -395,14 +498,28 @@ def read_knob(knob):
     with open(knob, 'r') as f:
         return f.read().strip()
 
+class Knob:
+    """ long-lived sysfs knob reader for polling loops: one pread per read,
+        no per-read open/close """
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def read(self):
+        return os.pread(self.fd, 64, 0).decode().strip()
+
+    def close(self):
+        os.close(self.fd)
+
 def configure_host(uut_collection, args):
     if not os.path.ismount("/mnt"):
         die(f'Error: /mnt is not a ramdisk')
 
     if args.delete:
-        cmd = 'sudo rm  -rf /mnt/afhba.*'
-        PR.Yellow(f'Erasing /mnt/afhba.*')
-        os.system(cmd)
+        stale_dirs = [entry.path for entry in os.scandir('/mnt') if entry.name.startswith('afhba.')]
+        if stale_dirs:
+            PR.Yellow(f'Erasing /mnt/afhba.*')
+            with ThreadPoolExecutor(max_workers=8) as ex:
+                list(ex.map(lambda path: subprocess.run(['sudo', 'rm', '-rf', path], check=False), stale_dirs))
 
     lport = list(uut_collection[0].streams.keys())[0]
     args.buffer_len = int(afhba404.get_buffer_len(lport) / 1024 / 1024)
@@ -427,6 +544,23 @@ def configure_host(uut_collection, args):
         args.t_mins, args.t_secs = divmod(args.secs, 60)
         args.nbuffers = 9999999999
 
+def cpu_percent_reader():
+    """ cpu usage from one /proc/stat readline per tick: avoids the psutil
+        object construction in the display loop """
+    def sample():
+        with open('/proc/stat') as f:
+            fields = list(map(int, f.readline().split()[1:8]))
+        return sum(fields), fields[3] + fields[4]
+    prev = sample()
+    def cpu_percent():
+        nonlocal prev
+        total, idle = sample()
+        dt = total - prev[0]
+        di = idle - prev[1]
+        prev = (total, idle)
+        return round(100 * (dt - di) / dt, 1) if dt else 0.0
+    return cpu_percent
+
 def die(message):
     PR.Red(message)
     os._exit(1)
@@ -525,22 +659,65 @@ def hot_run_init(uut_collection):
 
     return total_streams
 
-def hot_run_start(uut_collection):
-    def thread_wrapper(uut_item):
-        uut_item.thread = Thread(target=uut_item.get_state_forever)
-        uut_item.thread.daemon = True
-        uut_item.thread.start()
-        uut_item.start()
+# signalled by the state poller on any UUT state transition
+STATE_COND = Condition()
+
+def state_poller(uut_collection):
+    """ single cooperative poller: round-robins every UUT's state read,
+        honouring each UUT's poll_delay """
+    due = {uut_item.name: 0 for uut_item in uut_collection}
+    while True:
+        now = time.monotonic()
+        for uut_item in uut_collection:
+            if now >= due[uut_item.name]:
+                previous = uut_item.state
+                uut_item.get_state()
+                if uut_item.state != previous:
+                    uut_item.poll_delay = 1
+                    with STATE_COND:
+                        STATE_COND.notify_all()
+                due[uut_item.name] = time.monotonic() + uut_item.poll_delay
+        delay = min(due.values()) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+def wait_all_idle(uut_items, timeout=10):
+    """ block until every UUT reports IDLE, woken by the state poller:
+        returns the UUTs still pending at timeout """
+    deadline = time.monotonic() + timeout
+    with STATE_COND:
+        while True:
+            pending = [uut_item for uut_item in uut_items if uut_item.state != 'IDLE']
+            remaining = deadline - time.monotonic()
+            if not pending or remaining <= 0:
+                return pending
+            STATE_COND.wait(remaining)
 
+def hot_run_start(uut_collection):
+    poller = Thread(target=state_poller, args=(uut_collection, ))
+    poller.daemon = True
+    poller.start()
     for uut_item in uut_collection:
-        Thread(target=thread_wrapper, args=(uut_item, )).start()
+        Thread(target=uut_item.start).start()
 
 def hot_run_status_update_wrapper(SCRN, args, uut_collection):
+    # static per-stream display rows, built once: only the state values change per tick
+    stream_rows = {}
+    for uut_item in uut_collection:
+        stream_rows[uut_item.name] = [
+            (stream, f'{{TAB}}{stream.sites_str}:{stream.rport}{{ORANGE}} --> {{RESET}}afhba.{lport:2}')
+            for lport, stream in uut_item.streams.items()
+        ]
+    all_streams = [stream for rows in stream_rows.values() for stream, _ in rows]
+
     def hot_run_status_update():
         armed_uuts = 0
         running_uuts = 0
         ended_streams = 0
 
+        # one read pass for every stream state, then format from the local dict
+        sstates = {stream.lport: stream.read_state() for stream in all_streams}
+
         for uut_item in uut_collection:
             SCRN.add(f'{uut_item.name} ')
             if uut_item.state == 'RUN':
@@ -554,11 +731,9 @@ def hot_run_status_update_wrapper(SCRN, args, uut_collection):
                 SCRN.add(f'{{RED}}{uut_item.state}{{RESET}}:')
             SCRN.end()
 
-            for lport, stream in uut_item.streams.items():
-                sstate = stream.read_state()
-                sites = stream.sites_str
-                rport = stream.rport
-                SCRN.add_line(f'{{TAB}}{sites}:{rport}{{ORANGE}} --> {{RESET}}afhba.{lport:2}')
+            for stream, header in stream_rows[uut_item.name]:
+                sstate = sstates[stream.lport]
+                SCRN.add_line(header)
                 SCRN.add_line(f'{{TAB}}{{TAB}}{{BOLD}}{sstate.rx_rate * args.buffer_len}MB/s Total Buffers: {int(sstate.rx) * args.buffer_len:,} Status: {sstate.STATUS}{{RESET}}')
                 if args.check_spad:
                     SCRN.add_line(f'{{TAB}}{{TAB}}Spad Checking {stream.read_results()}')
@@ -583,16 +758,19 @@ def dry_run(args, uut_collection):
 
 
 class RateLimiter:
-    """ limits cycle rate """
+    """ limits cycle rate against a fixed monotonic deadline: no wall-clock
+        jumps, no accumulated drift """
     def __init__(self, _cycle_max):
         self.cycle_max = _cycle_max
-        self.cycle_start = time.time()
+        self.deadline = time.monotonic_ns()
 
     def __call__(self):
-            cycle_length = time.time() - self.cycle_start
-            sleep_time = 0 if cycle_length > self.cycle_max else self.cycle_max - cycle_length
-            time.sleep(sleep_time)
-            self.cycle_start = time.time()
+            self.deadline += int(self.cycle_max * 1e9)
+            now = time.monotonic_ns()
+            if now < self.deadline:
+                time.sleep((self.deadline - now) / 1e9)
+            else:
+                self.deadline = now
 
 def hot_run(args, uut_collection):
     SCRN = DISPLAY()
@@ -607,7 +785,8 @@ def hot_run(args, uut_collection):
     rate_limiter = RateLimiter(0.5)
 
     usage_arr = []
-    psutil.cpu_percent()
+    cpu_percent = cpu_percent_reader()
+    stop_thread = None
 
     try:
         while True:
@@ -628,7 +807,7 @@ def hot_run(args, uut_collection):
                 SCRN.add("Max: {0}MB Buffer Length: {1}MB ", args.nbuffers * args.buffer_len, args.buffer_len)
             
             if args.cpu_usage and all_running:
-                cur_usage = psutil.cpu_percent()
+                cur_usage = cpu_percent()
                 usage_arr.append(cur_usage)
                 SCRN.add(f'CPU Usage {cur_usage}% ')
 
@@ -640,13 +819,13 @@ def hot_run(args, uut_collection):
             if sec_count and time.time() - time_start > args.secs:
                 SCRN.add_line('{BOLD}Time Limit Reached Stopping{RESET}')
                 if running_uuts > 0:
-                    stop_uuts(uut_collection)
+                    stop_thread = stop_uuts(uut_collection) or stop_thread
                 else:
                     break
             elif ended_streams == total_streams:
                 SCRN.add_line('{BOLD}Buffer limit Reached Stopping{RESET}')
                 if running_uuts > 0:
-                    stop_uuts(uut_collection)
+                    stop_thread = stop_uuts(uut_collection) or stop_thread
                 else:
                     break
 
@@ -658,13 +837,15 @@ def hot_run(args, uut_collection):
     except KeyboardInterrupt:
         SCRN.render_interrupted()
         PR.Red('Interrupt!')
-        stop_uuts(uut_collection)
+        stop_thread = stop_uuts(uut_collection) or stop_thread
     except Exception as e:
         SCRN.render_interrupted()
         PR.Red('Fatal Error')
-        stop_uuts(uut_collection)
+        stop_thread = stop_uuts(uut_collection) or stop_thread
         print(e)
         print(traceback.format_exc())
+    if stop_thread is not None:
+        stop_thread.join()
     if len(usage_arr) > 1:
         mean_usage = round(sum(usage_arr) / len(usage_arr))
         print(f"Mean Usage {mean_usage}%")
@@ -95,6 +95,87 @@ struct SEQ {
 /* number of buffers to transfer - set on command line or use module knob. */
 unsigned transfer_buffers;
 
+#ifdef HAVE_LIBURING
+#include <liburing.h>
+#include <string.h>
+
+static struct io_uring iou_ring;
+static int IOU_ENABLED;
+static int IOU_REGBUF;
+
+/* opt-in via IOU_SQPOLL=1 and/or IOU_REGBUF=1 in the environment.
+ * SQPOLL keeps submission off the syscall path (needs 5.11+ for
+ * unregistered files), REGBUF registers the DMA host buffer mappings
+ * once so the kernel skips per-write pin/unpin.
+ */
+static void iou_init(void)
+{
+	int sqpoll = getenv("IOU_SQPOLL")? atoi(getenv("IOU_SQPOLL")): 0;
+	int regbuf = getenv("IOU_REGBUF")? atoi(getenv("IOU_REGBUF")): 0;
+	struct io_uring_params params = {};
+	int rc;
+
+	if (!sqpoll && !regbuf){
+		return;
+	}
+	if (sqpoll){
+		params.flags |= IORING_SETUP_SQPOLL;
+		params.sq_thread_idle = 1000;
+	}
+	/* liburing returns -errno without setting errno, so no perror here */
+	rc = io_uring_queue_init_params(RTM_T_Device::MAXBUF, &iou_ring, &params);
+	if (rc != 0){
+		fprintf(stderr, "io_uring_queue_init: %s, falling back to write(2)\n",
+				strerror(-rc));
+		return;
+	}
+	IOU_ENABLED = 1;
+	info("io_uring enabled%s", sqpoll? " SQPOLL": "");
+
+	if (regbuf){
+		struct iovec *iov = new struct iovec[dev->nbuffers];
+		for (unsigned ib = 0; ib < dev->nbuffers; ++ib){
+			iov[ib].iov_base = dev->getHostBufferMappingW(ib);
+			iov[ib].iov_len = dev->maxlen;
+		}
+		rc = io_uring_register_buffers(&iou_ring, iov, dev->nbuffers);
+		if (rc == 0){
+			IOU_REGBUF = 1;
+			info("io_uring registered %d buffers", dev->nbuffers);
+		}else{
+			fprintf(stderr, "io_uring_register_buffers: %s\n", strerror(-rc));
+		}
+		delete [] iov;
+	}
+}
+
+/* completion is reaped before return: bufno is handed back to the driver
+ * right after process(), so the write must have left the DMA buffer.
+ * offset -1 : append at the current file position, as write(2) does.
+ */
+static int iou_write(int fd, int ibuf, const void* data, int len)
+{
+	struct io_uring_sqe *sqe = io_uring_get_sqe(&iou_ring);
+	struct io_uring_cqe *cqe;
+	int rc;
+
+	if (sqe == 0){
+		return -1;
+	}
+	if (IOU_REGBUF){
+		io_uring_prep_write_fixed(sqe, fd, data, len, (__u64)-1, ibuf);
+	}else{
+		io_uring_prep_write(sqe, fd, data, len, (__u64)-1);
+	}
+	if (io_uring_submit(&iou_ring) < 0 || io_uring_wait_cqe(&iou_ring, &cqe) < 0){
+		return -1;
+	}
+	rc = cqe->res;
+	io_uring_cqe_seen(&iou_ring, cqe);
+	return rc;
+}
+#endif
+
 static double htime(void){
 	static struct timeval t0;
 	static int t0_valid;
@@ -293,7 +374,25 @@ static void process(int ibuf, int nbuf, struct StreamBufferDef *sbd){
 
 	if (WRITE_LEN != 0){
 		int len = WRITE_LEN == WRITE_LEN_ALL? dev->maxlen: WRITE_LEN;
-		int rc = write(outfp, dev->getHostBufferMapping(ibuf), len);
+		int rc;
+#ifdef HAVE_LIBURING
+		if (IOU_ENABLED){
+			rc = iou_write(outfp, ibuf, dev->getHostBufferMapping(ibuf), len);
+			if (rc < 0){
+				/* any io_uring failure: retry this buffer with
+				 * write(2) and stay there, do not kill the capture
+				 */
+				fprintf(stderr, "iou_write: %s, falling back to write(2)\n",
+						rc == -1? "submission failed": strerror(-rc));
+				IOU_ENABLED = 0;
+			}
+		}
+		if (!IOU_ENABLED){
+			rc = write(outfp, dev->getHostBufferMapping(ibuf), len);
+		}
+#else
+		rc = write(outfp, dev->getHostBufferMapping(ibuf), len);
+#endif
 		if (rc != len){
 			perror("write fail");
 			exit(1);
@@ -510,6 +609,9 @@ static void init_defaults(int argc, char* argv[])
 	if (getenv("OUTPUT_META")){
 		OUTPUT_META = atoi(getenv("OUTPUT_META"));
 	}
+#ifdef HAVE_LIBURING
+	iou_init();
+#endif
 	setvbuf(stdout, 0, _IOLBF, 0);
 
 	char* monitor;